@@ -1,53 +1,155 @@
 import re
 import argparse
-
-def convert_shadertoy_to_glsl(shadertoy_shader):
-    """
-    Converts a ShaderToy shader to a GLSL shader suitable for OpenGL.
-    """
-    # Replace ShaderToy variables with OpenGL equivalents
-    glsl_shader = shadertoy_shader
-
-    # Replace `iResolution` with a uniform vec2
-    glsl_shader = re.sub(r'\biResolution\b', 'uResolution', glsl_shader)
-
-    # Replace `iTime` with a uniform float
-    glsl_shader = re.sub(r'\biTime\b', 'uTime', glsl_shader)
-
-    # Replace `void mainImage` with `void main()`
-    glsl_shader = re.sub(r'void mainImage\( out vec4 fragColor, in vec2 fragCoord \)', 'void main()', glsl_shader)
-
-    # Replace `fragCoord` with `gl_FragCoord.xy`
-    glsl_shader = re.sub(r'\bfragCoord\b', 'gl_FragCoord.xy', glsl_shader)
-
-    # Add version and uniform definitions at the beginning
-    header = '''#version 330 core
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+# ShaderToy tokens and their OpenGL equivalents, rewritten in a single pass
+# over the encoded source. The mainImage signature is matched as a whole so
+# the `fragCoord` parameter inside it is not rewritten on its own.
+# Every alternative starts with a literal, which lets the regex engine skip
+# ahead to the next candidate first character (`i`, `f` or `v`) in C; the
+# word boundaries around the tokens are checked afterwards on the few
+# candidates only, as `\b` in the pattern would defeat that skipping.
+_COMBINED_BYTES = re.compile(
+    rb'iResolution'
+    rb'|iTime'
+    rb'|fragCoord'
+    rb'|void\s+mainImage\s*\([^)]*\)')
+_REPLS = {
+    b'iResolution': b'uResolution',    # uniform vec2
+    b'iTime': b'uTime',                # uniform float
+    b'fragCoord': b'gl_FragCoord.xy',
+}
+_MAIN_REPL = b'void main()'
+_WORD_BYTES = frozenset(b'_0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+# Version of the conversion rules, bump whenever the rewrites change the output
+# so programs cached from an older conversion are not reused
+CONVERTER_VERSION = 1
+
+# Version and uniform definitions added at the beginning of every converted shader
+HEADER = '''#version 330 core
 uniform float uTime;         // Equivalent to iTime
 uniform vec2 uResolution;    // Equivalent to iResolution
 out vec4 fragColor;          // Output variable
 '''
-    glsl_shader = header + glsl_shader
+_HEADER_BYTES = HEADER.encode('utf-8')
+
+# Same as HEADER, but with the uniforms in a std140 uniform block so they can be
+# fed from a uniform buffer. Used by showshader.py for its in-memory conversion;
+# written files keep plain uniforms that any host program can set with glUniform*.
+UNIFORM_BLOCK_HEADER = '''#version 330 core
+layout(std140) uniform Uniforms {
+    vec2 uResolution;        // Equivalent to iResolution
+    float uTime;             // Equivalent to iTime
+};
+out vec4 fragColor;          // Output variable
+'''
+_UNIFORM_BLOCK_HEADER_BYTES = UNIFORM_BLOCK_HEADER.encode('utf-8')
 
-    return glsl_shader
+def convert_shadertoy_to_glsl(shadertoy_shader, uniform_block=False):
+    """
+    Converts a ShaderToy shader to a GLSL shader suitable for OpenGL.
+    With uniform_block set, uTime and uResolution are declared in the
+    `Uniforms` uniform block instead of as plain uniforms.
+    """
+    # Replace ShaderToy variables with OpenGL equivalents and
+    # `void mainImage(...)` with `void main()`, copying the unchanged
+    # runs between matches straight from the source buffer. The output
+    # starts out with the header, so the final string is decoded once at
+    # its exact size instead of being concatenated with the header.
+    buf = shadertoy_shader.encode('utf-8')
+    view = memoryview(buf)
+    size = len(buf)
+    out = bytearray(_UNIFORM_BLOCK_HEADER_BYTES if uniform_block else _HEADER_BYTES)
+    prev = 0
+    for m in _COMBINED_BYTES.finditer(buf):
+        start, end = m.span()
+        repl = _REPLS.get(m.group(0))
+        if repl is None:
+            repl = _MAIN_REPL
+        elif (start and buf[start - 1] in _WORD_BYTES) or (end < size and buf[end] in _WORD_BYTES):
+            # Part of a longer identifier such as `iTimeScale`
+            continue
+        out += view[prev:start]
+        out += repl
+        prev = end
+    out += view[prev:]
+    return out.decode('utf-8')
 
 def read_shader_from_file(file_path):
     """Reads the shader from the input file."""
-    with open(file_path, 'r') as file:
-        return file.read()
+    return Path(file_path).read_text(encoding='utf-8')
 
 def write_shader_to_file(file_path, shader_code):
-    """Writes the converted GLSL shader to the output file."""
-    with open(file_path, 'w') as file:
-        file.write(shader_code)
+    """Writes the converted GLSL shader to the output file.
+    The shader is written to a temporary file first and then moved over
+    the output file, so readers never see a partially written shader."""
+    data = memoryview(shader_code.encode('utf-8'))
+    file_path = os.fspath(file_path)
+    tmp = file_path + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, file_path)
+    except BaseException:
+        # Do not leave a stray temporary file next to the output
+        os.unlink(tmp)
+        raise
+
+def _worker(path, out_dir):
+    """Converts a single shader file, writing `<name>.glsl` into out_dir.
+    Returns the error message if the file could not be converted, else None."""
+    output_file = Path(out_dir) / (Path(path).stem + '.glsl')
+    try:
+        write_shader_to_file(output_file, convert_shadertoy_to_glsl(read_shader_from_file(path)))
+    except (OSError, UnicodeError) as e:
+        # Report the file instead of aborting the rest of the batch
+        return str(e)
+    return None
+
+def convert_many(paths, out_dir, workers=None):
+    """Converts many shader files in parallel, one file per worker process.
+    Returns a (path, error) pair per file, where error is None if the file was converted."""
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(workers) as executor:
+        errors = executor.map(partial(_worker, out_dir=out_dir), paths, chunksize=16)
+        return list(zip(paths, errors))
 
 def main():
     # Parse command-line arguments
     parser = argparse.ArgumentParser(
         description="A program to convert shadertoy.com shaders to GLSL shaders for OpenGL.")
-    parser.add_argument("input_file", help="The name of the shadertoy.com shader file to convert")
-    parser.add_argument("output_file", help="The name of the glsl shader file to write to")
+    parser.add_argument("input_file", nargs="?", help="The name of the shadertoy.com shader file to convert")
+    parser.add_argument("output_file", nargs="?", help="The name of the glsl shader file to write to")
+    parser.add_argument("--batch", metavar="DIR",
+                        help="Convert every *.frag shader file in DIR instead of a single file")
+    parser.add_argument("--out-dir", metavar="DIR",
+                        help="The directory to write batch converted shaders to (default: the batch directory)")
     args = parser.parse_args()
 
+    if args.batch:
+        paths = sorted(Path(args.batch).glob('*.frag'))
+        out_dir = args.out_dir or args.batch
+        results = convert_many(paths, out_dir)
+        failed = [(path, error) for path, error in results if error is not None]
+        for path, error in failed:
+            print(f"Failed to convert {path}: {error}")
+        print(f"Converted {len(results) - len(failed)} shaders written to {out_dir}")
+        if failed:
+            exit(1)
+        return
+
+    if not args.input_file or not args.output_file:
+        parser.error("input_file and output_file are required unless --batch is given")
+
     input_file = args.input_file
     output_file = args.output_file
 
@@ -1,22 +1,86 @@
+import os
+
+# Set SHADERTOY_DEBUG_GL=1 to check for OpenGL errors after every GL call (PyOpenGL's
+# ERROR_CHECKING) and after every frame. Each check calls glGetError, which stalls
+# the GL pipeline, so this is off by default.
+DEBUG_GL = bool(os.environ.get('SHADERTOY_DEBUG_GL'))
+
+import OpenGL
+OpenGL.ERROR_CHECKING = DEBUG_GL  # Must be set before OpenGL.GL is imported
+
 import pygame
 from OpenGL.GL import *
-from OpenGL.GL.shaders import compileProgram, compileShader
+from OpenGL.GL.shaders import compileShader
+from OpenGL.GL.ARB.buffer_storage import glInitBufferStorageARB
+from OpenGL.GL.ARB.direct_state_access import glInitDirectStateAccessARB
+from OpenGL.GL.ARB.get_program_binary import glInitGetProgramBinaryARB
 import numpy as np
 import time
 import traceback  # For detailed traceback
 import argparse
+import ctypes
+import hashlib
+import re
+import struct
+from pathlib import Path
+
+from shadertoys_to_glsl import CONVERTER_VERSION, UNIFORM_BLOCK_HEADER, convert_shadertoy_to_glsl
+
+# Name and binding point of the uniform block declared by ShaderToy shaders converted in memory
+UNIFORM_BLOCK_NAME = "Uniforms"
+UNIFORM_BLOCK_BINDING = 0
+
+# Number of slots in the persistently mapped uniform buffer. Each frame writes the next
+# slot, so the GPU can still be reading the slots of the frames queued before it.
+UNIFORM_RING_SLOTS = 3
+
+# Size of the uniform block's std140 contents: vec2 uResolution, float uTime, padding
+UNIFORM_BLOCK_SIZE = 16
+
+# Longest wait for the GPU to release a uniform buffer slot before giving up
+FENCE_TIMEOUT_NS = 1_000_000_000
+
+# Directory holding linked program binaries from previous runs
+PROGRAM_CACHE_DIR = Path.home() / '.cache' / 'shadertoy_glsl'
+
+# Linked programs of this process, keyed by the source hash also naming their on-disk cache file
+_PROGRAM_CACHE: dict[str, int] = {}
+
+# Vertex shader emitting the corners of a full-screen quad from gl_VertexID,
+# so no vertex buffer is needed
+_VERTEX_SRC = """
+#version 330 core
+const vec2 corners[4] = vec2[4](vec2(-1.0, -1.0), vec2(1.0, -1.0), vec2(-1.0, 1.0), vec2(1.0, 1.0));
+
+void main() {
+    gl_Position = vec4(corners[gl_VertexID], 0.0, 1.0);
+}
+"""
+
+# Sniffs the ShaderToy entry point `mainImage(...)`
+_RE_MAIN_IMAGE = re.compile(r'\bmainImage\s*\(')
+
+# Compiled vertex shader, shared by every program since its source never changes
+_VERTEX_SHADER = None
 
 # Function to load the shader source code from a file
 def load_shader_source(file_path):
     try:
-        with open(file_path, 'r') as file:
-            return file.read()
+        return Path(file_path).read_text(encoding='utf-8')
     except Exception as e:
         print(f"Error loading shader from file {file_path}: {e}")
         traceback.print_exc()
         exit(1)
 
 
+# Function to check whether shader source is a ShaderToy shader rather than plain GLSL.
+# GLSL files start with a #version directive, which ShaderToy shaders never have.
+def is_shadertoy_source(shader_source):
+    if shader_source.lstrip().startswith('#version'):
+        return False
+    return _RE_MAIN_IMAGE.search(shader_source) is not None
+
+
 # Function to get the compilation log for a shader
 def get_shader_log(shader):
     log_length = glGetShaderiv(shader, GL_INFO_LOG_LENGTH)
@@ -24,51 +88,138 @@ def get_shader_log(shader):
     return log
 
 
-# Function to create a full-screen quad (two triangles that cover the screen)
-def create_fullscreen_quad():
+# Function to create the vertex array object for the full-screen quad.
+# It has no attributes, a core profile just requires one to be bound for drawing.
+def create_empty_vao():
     try:
-        quad_vertices = np.array([
-            -1.0, -1.0, 0.0,
-            1.0, -1.0, 0.0,
-            -1.0, 1.0, 0.0,
-            1.0, 1.0, 0.0,
-        ], dtype=np.float32)
-
-        vao = glGenVertexArrays(1)
-        glBindVertexArray(vao)
+        return glGenVertexArrays(1)
+    except Exception as e:
+        print(f"Error creating vertex array object: {e}")
+        traceback.print_exc()
+        exit(1)
+
+
+# Function to query a single integer OpenGL state value
+def get_gl_integer(name):
+    return int(np.ravel(glGetIntegerv(name))[0])
+
+
+# Function to get the OpenGL version of the current context as a (major, minor) tuple.
+# Core entry points resolve whether or not the context supports them, so checking a
+# function with bool() does not tell whether it can be used; check the version instead.
+def get_gl_version():
+    return (get_gl_integer(GL_MAJOR_VERSION), get_gl_integer(GL_MINOR_VERSION))
+
+
+# Function to check whether the context supports program binaries (OpenGL 4.1 or ARB_get_program_binary)
+def has_program_binary():
+    return get_gl_version() >= (4, 1) or bool(glInitGetProgramBinaryARB())
+
+
+# Function to check whether the context supports persistently mapped buffers (OpenGL 4.4 or ARB_buffer_storage)
+def has_buffer_storage():
+    return get_gl_version() >= (4, 4) or bool(glInitBufferStorageARB())
+
+
+# Function to check whether the context supports direct state access (OpenGL 4.5 or ARB_direct_state_access)
+def has_direct_state_access():
+    return get_gl_version() >= (4, 5) or bool(glInitDirectStateAccessARB())
 
-        vbo = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, vbo)
-        glBufferData(GL_ARRAY_BUFFER, quad_vertices.nbytes, quad_vertices, GL_STATIC_DRAW)
 
-        glEnableVertexAttribArray(0)
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 0, None)
+# Function to hash cache key parts together with the driver identification,
+# since a program binary is only valid for the driver that produced it
+def get_driver_cache_key(*parts):
+    key = hashlib.sha256()
+    for part in parts:
+        key.update(part.encode('utf-8'))
+    for name in (GL_VENDOR, GL_RENDERER, GL_VERSION):
+        key.update(glGetString(name) or b'')
+    return key.hexdigest()
 
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
-        glBindVertexArray(0)
 
-        return vao
+# Function to get the on-disk cache path for a program built from the given fragment shader
+def get_program_cache_path(fragment_shader_source):
+    return PROGRAM_CACHE_DIR / f"{get_driver_cache_key(fragment_shader_source, _VERTEX_SRC)}.bin"
+
+
+# Function to get the path of the file referring a shader file's (path, mtime, size) to its cached program.
+# The conversion is part of the key, since ShaderToy files are compiled from their converted source.
+def get_file_cache_ref_path(file_path, stat):
+    stat_key = f"{os.path.abspath(file_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+    converter_key = f"{CONVERTER_VERSION}:{UNIFORM_BLOCK_HEADER}"
+    return PROGRAM_CACHE_DIR / f"{get_driver_cache_key(stat_key, converter_key, _VERTEX_SRC)}.ref"
+
+
+# Function to load a previously linked program binary, returns None if unavailable
+def load_program_binary(cache_path):
+    if not cache_path.is_file() or not has_program_binary():
+        return None
+
+    program = 0
+    try:
+        data = cache_path.read_bytes()
+        (binary_format,) = struct.unpack_from('<I', data)
+        binary = np.frombuffer(data, dtype=np.uint8, offset=4)
+
+        program = glCreateProgram()
+        glProgramBinary(program, binary_format, binary, binary.size)
+        if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+            # Driver rejected the binary (e.g. after a driver update)
+            glDeleteProgram(program)
+            return None
+        print(f"Loaded shader program from cache {cache_path}")
+        return program
     except Exception as e:
-        print(f"Error creating fullscreen quad: {e}")
-        traceback.print_exc()
-        exit(1)
+        print(f"Ignoring shader program cache {cache_path}: {e}")
+        if program:
+            glDeleteProgram(program)
+        return None
 
 
-# Function to compile and link the shaders into an OpenGL program
-def create_shader_program(fragment_shader_source):
-    vertex_shader_source = """
-    #version 330 core
-    layout(location = 0) in vec3 inPosition;
+# Function to store a linked program binary for later runs
+def save_program_binary(program, cache_path):
+    if not has_program_binary():
+        return
 
-    void main() {
-        gl_Position = vec4(inPosition, 1.0);
-    }
-    """
+    try:
+        binary_length = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+        if binary_length <= 0:
+            return
+
+        length = np.zeros(1, dtype=np.int32)
+        binary_format = np.zeros(1, dtype=np.uint32)
+        binary = np.empty(binary_length, dtype=np.uint8)
+        glGetProgramBinary(program, binary_length, length, binary_format, binary)
 
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_bytes(struct.pack('<I', int(binary_format[0])) + binary[:length[0]].tobytes())
+    except Exception as e:
+        # Caching is best effort, the program itself is fine
+        print(f"Unable to cache shader program: {e}")
+
+
+# Function to compile and link the shaders into an OpenGL program.
+# Callers that already computed the program's on-disk cache path can pass it in,
+# the source is then not hashed again.
+def create_shader_program(fragment_shader_source, cache_path=None):
+    if cache_path is None:
+        cache_path = get_program_cache_path(fragment_shader_source)
+    key = cache_path.stem
+    if key in _PROGRAM_CACHE:
+        return _PROGRAM_CACHE[key]
+
+    shader_program = load_program_binary(cache_path)
+    if shader_program is not None:
+        _PROGRAM_CACHE[key] = shader_program
+        return shader_program
+
+    global _VERTEX_SHADER
     try:
-        print("Compiling vertex shader...")
-        vertex_shader = compileShader(vertex_shader_source, GL_VERTEX_SHADER)
-        print("Vertex shader compiled successfully.")
+        if _VERTEX_SHADER is None:
+            print("Compiling vertex shader...")
+            _VERTEX_SHADER = compileShader(_VERTEX_SRC, GL_VERTEX_SHADER)
+            print("Vertex shader compiled successfully.")
+        vertex_shader = _VERTEX_SHADER
     except RuntimeError as e:
         print(f"Vertex shader compilation failed:\n{e}")
         print(f"Shader log:\n{get_shader_log(vertex_shader)}")  # Print shader log
@@ -87,13 +238,122 @@ def create_shader_program(fragment_shader_source):
 
     try:
         print("Linking shaders into a program...")
-        shader_program = compileProgram(vertex_shader, fragment_shader)
+        # Linked by hand rather than with compileProgram, which deletes the
+        # shaders it is given and so would throw away the shared vertex shader
+        shader_program = glCreateProgram()
+        glAttachShader(shader_program, vertex_shader)
+        glAttachShader(shader_program, fragment_shader)
+        if has_program_binary():
+            glProgramParameteri(shader_program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+        glLinkProgram(shader_program)
+        if glGetProgramiv(shader_program, GL_LINK_STATUS) != GL_TRUE:
+            raise RuntimeError(glGetProgramInfoLog(shader_program).decode('utf-8'))
+
+        # Keep the vertex shader alive for the next program
+        glDetachShader(shader_program, vertex_shader)
+        glDetachShader(shader_program, fragment_shader)
+        glDeleteShader(fragment_shader)
         print("Shader program linked successfully.")
     except RuntimeError as e:
         print(f"Shader program linking failed:\n{e}")
         traceback.print_exc()
         exit(1)
 
+    save_program_binary(shader_program, cache_path)
+    _PROGRAM_CACHE[key] = shader_program
+
+    return shader_program
+
+
+# Function to create the buffer backing the shader's uniform block.
+# Returns the buffer, a float32 view of its contents with one row per slot (uResolution.xy,
+# uTime, padding, then alignment padding), the byte size of a slot and whether the view is
+# persistently mapped GPU memory or has to be uploaded after changes.
+# A mapped buffer is a ring of UNIFORM_RING_SLOTS slots: the GPU reads it directly, so a
+# slot may only be written once the draw that last used it has completed (see wait_for_fence).
+def create_uniform_buffer(shader_program, block_index, resolution):
+    glUniformBlockBinding(shader_program, block_index, UNIFORM_BLOCK_BINDING)
+    flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+
+    if not has_buffer_storage():
+        uniform_data = np.array([[resolution[0], resolution[1], 0.0, 0.0]], dtype=np.float32)
+        uniform_buffer = glGenBuffers(1)
+        glBindBuffer(GL_UNIFORM_BUFFER, uniform_buffer)
+        glBufferData(GL_UNIFORM_BUFFER, uniform_data.nbytes, uniform_data, GL_DYNAMIC_DRAW)
+        glBindBufferBase(GL_UNIFORM_BUFFER, UNIFORM_BLOCK_BINDING, uniform_buffer)
+        return uniform_buffer, uniform_data, UNIFORM_BLOCK_SIZE, False
+
+    # Slots have to start at a multiple of the uniform buffer offset alignment
+    alignment = get_gl_integer(GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT)
+    slot_size = -(-UNIFORM_BLOCK_SIZE // alignment) * alignment
+    uniform_data = np.zeros((UNIFORM_RING_SLOTS, slot_size // 4), dtype=np.float32)
+    uniform_data[:, 0] = resolution[0]
+    uniform_data[:, 1] = resolution[1]
+
+    if has_direct_state_access():
+        # Direct state access, the buffer is created, filled and mapped without binding it
+        buffers = np.zeros(1, dtype=np.uint32)
+        glCreateBuffers(1, buffers)
+        uniform_buffer = int(buffers[0])
+        glNamedBufferStorage(uniform_buffer, uniform_data.nbytes, uniform_data, flags)
+        pointer = glMapNamedBufferRange(uniform_buffer, 0, uniform_data.nbytes, flags)
+    else:
+        uniform_buffer = glGenBuffers(1)
+        glBindBuffer(GL_UNIFORM_BUFFER, uniform_buffer)
+        glBufferStorage(GL_UNIFORM_BUFFER, uniform_data.nbytes, uniform_data, flags)
+        pointer = glMapBufferRange(GL_UNIFORM_BUFFER, 0, uniform_data.nbytes, flags)
+
+    if not pointer:
+        raise RuntimeError("Unable to map uniform buffer")
+    mapped = np.ctypeslib.as_array(ctypes.cast(pointer, ctypes.POINTER(ctypes.c_float)), shape=uniform_data.shape)
+    return uniform_buffer, mapped, slot_size, True
+
+
+# Function to wait until the GPU has finished the commands issued before a fence, then delete the fence
+def wait_for_fence(fence):
+    result = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, FENCE_TIMEOUT_NS)
+    glDeleteSync(fence)
+    if result not in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+        # Writing anyway could change memory the GPU is still reading
+        raise RuntimeError(f"Waiting for the GPU to release the uniform buffer failed: {result}")
+
+
+# Function to create the shader program for a shader file. When the file is unchanged
+# since a previous run (same path, mtime and size) the cached program is loaded without
+# reading or hashing the shader source at all.
+def create_shader_program_from_file(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError as e:
+        print(f"Error loading shader from file {file_path}: {e}")
+        exit(1)
+
+    ref_path = get_file_cache_ref_path(file_path, stat)
+    if ref_path.is_file():
+        try:
+            cache_name = ref_path.read_text(encoding='utf-8')
+        except (OSError, UnicodeDecodeError) as e:
+            # Caching is best effort, a broken entry just means compiling from source
+            print(f"Ignoring shader program cache {ref_path}: {e}")
+        else:
+            shader_program = load_program_binary(PROGRAM_CACHE_DIR / cache_name)
+            if shader_program is not None:
+                return shader_program
+
+    # First load of this file version, the source hash decides whether a cached program exists
+    fragment_shader_source = load_shader_source(file_path)
+    if is_shadertoy_source(fragment_shader_source):
+        # Convert in memory instead of going through an intermediate GLSL file
+        fragment_shader_source = convert_shadertoy_to_glsl(fragment_shader_source, uniform_block=True)
+    cache_path = get_program_cache_path(fragment_shader_source)
+    shader_program = create_shader_program(fragment_shader_source, cache_path)
+
+    if cache_path.is_file():
+        try:
+            ref_path.write_text(cache_path.name, encoding='utf-8')
+        except OSError as e:
+            print(f"Unable to cache shader program: {e}")
+
     return shader_program
 
 
@@ -115,7 +375,8 @@ def check_opengl_errors():
 
 def main():
     parser = argparse.ArgumentParser(description="A program to display a shader using OpenGL.")
-    parser.add_argument("shaderfile", help="The fragment shader file to display.")
+    parser.add_argument("shaderfile",
+                        help="The fragment shader file to display, either GLSL or a shadertoy.com shader.")
 
     args = parser.parse_args()
 
@@ -125,6 +386,10 @@ def main():
         screen_size = (800, 600)
         pygame.display.set_mode(screen_size, pygame.OPENGL | pygame.DOUBLEBUF)
 
+        # Only QUIT is handled, so drop every other event inside SDL
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed([pygame.QUIT])
+
         # Set OpenGL clear color (background color)
         glClearColor(0.1, 0.1, 0.1, 1.0)
         check_opengl_errors()
@@ -135,62 +400,94 @@ def main():
             raise RuntimeError("Unable to get OpenGL version")
         print(f"OpenGL Version: {info.decode()}")
 
-        # Load fragment shader from a file
-
+        # Load the fragment shader from a file and compile and link it into a program
         fragment_shader_file = args.shaderfile
-        fragment_shader_source = load_shader_source(fragment_shader_file)
+        shader_program = create_shader_program_from_file(fragment_shader_file)
 
-        # Compile and link shaders into a program
-        shader_program = create_shader_program(fragment_shader_source)
-
-        # Create a full-screen quad
-        vao = create_fullscreen_quad()
-
-        # Set up uniforms
-        resolution_location = glGetUniformLocation(shader_program, "uResolution")
-        if resolution_location == -1:
-            print("Warning: 'uResolution' uniform not found in shader.")
-        time_location = glGetUniformLocation(shader_program, "uTime")  # For uTime uniform
-        if time_location == -1:
-            print("Warning: 'uTime' uniform not found in shader.")
+        # Create the (empty) vertex array for the full-screen quad. It is the only
+        # vertex array ever used, so it stays bound for the lifetime of the program.
+        vao = create_empty_vao()
+        glBindVertexArray(vao)
 
+        # Set up uniforms, either through the uniform block of ShaderToy shaders
+        # converted in memory or as plain uniforms for GLSL files
         glUseProgram(shader_program)  # Use the shader program to set uniforms
-        glUniform2f(resolution_location, screen_size[0], screen_size[1])
+        uniform_buffer = None
+        block_index = glGetUniformBlockIndex(shader_program, UNIFORM_BLOCK_NAME)
+        if block_index != GL_INVALID_INDEX:
+            uniform_buffer, uniform_view, uniform_slot_size, uniform_mapped = create_uniform_buffer(
+                shader_program, block_index, screen_size)
+        else:
+            resolution_location = glGetUniformLocation(shader_program, "uResolution")
+            if resolution_location == -1:
+                print("Warning: 'uResolution' uniform not found in shader.")
+            time_location = glGetUniformLocation(shader_program, "uTime")  # For uTime uniform
+            if time_location == -1:
+                print("Warning: 'uTime' uniform not found in shader.")
+            glUniform2f(resolution_location, screen_size[0], screen_size[1])
         check_opengl_errors()
 
-        start_time = time.time()  # Record the start time for uTime calculation
+        # Local aliases avoid a global lookup per call in the render loop
+        _uniform1f = glUniform1f
+        _drawArrays = glDrawArrays
+
+        # Ring slot of the mapped uniform buffer written this frame, and per slot
+        # the fence after the last draw reading it
+        uniform_slot = 0
+        slot_fences = [None] * UNIFORM_RING_SLOTS
+
+        # Caps the frame rate so the loop does not spin as fast as the GPU allows
+        clock = pygame.time.Clock()
+
+        start_time = time.perf_counter()  # Record the start time for uTime calculation
 
         # Main render loop
         running = True
         while running:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    running = False
+            # Drain the queue in one pump; pygame may still let a few internal events through
+            if any(event.type == pygame.QUIT for event in pygame.event.get()):
+                running = False
 
             # Calculate elapsed time
-            current_time = time.time() - start_time
+            current_time = time.perf_counter() - start_time
 
             # Clear the screen
             glClear(GL_COLOR_BUFFER_BIT)
-            check_opengl_errors()
-
-            # Use the shader program
-            glUseProgram(shader_program)
 
-            # Update time uniform
-            glUniform1f(time_location, current_time)
+            # Update time uniform. A mapped uniform buffer gets the time in the next ring
+            # slot, whose fence is from several frames back and has normally signalled.
+            if uniform_buffer is None:
+                _uniform1f(time_location, current_time)
+            elif uniform_mapped:
+                uniform_slot = (uniform_slot + 1) % UNIFORM_RING_SLOTS
+                if slot_fences[uniform_slot] is not None:
+                    wait_for_fence(slot_fences[uniform_slot])
+                    slot_fences[uniform_slot] = None
+                uniform_view[uniform_slot, 2] = current_time
+                glBindBufferRange(GL_UNIFORM_BUFFER, UNIFORM_BLOCK_BINDING, uniform_buffer,
+                                  uniform_slot * uniform_slot_size, UNIFORM_BLOCK_SIZE)
+            else:
+                uniform_view[0, 2] = current_time
+                glBufferSubData(GL_UNIFORM_BUFFER, 0, uniform_view.nbytes, uniform_view)
 
             # Draw the full-screen quad
-            glBindVertexArray(vao)
-            glDrawArrays(GL_TRIANGLE_STRIP, 0, 4)
-            check_opengl_errors()  # Check for errors after drawing
-            glBindVertexArray(0)
+            _drawArrays(GL_TRIANGLE_STRIP, 0, 4)
+            if uniform_buffer is not None and uniform_mapped:
+                slot_fences[uniform_slot] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+            if DEBUG_GL:
+                check_opengl_errors()  # Check for errors after drawing
 
             # Swap the display buffers (double buffering)
             pygame.display.flip()
+            clock.tick(60)
 
         # Cleanup and exit
         glDeleteVertexArrays(1, [vao])
+        for fence in slot_fences:
+            if fence is not None:
+                glDeleteSync(fence)
+        if uniform_buffer is not None:
+            glDeleteBuffers(1, [uniform_buffer])
         glDeleteProgram(shader_program)
         pygame.quit()
 